@@ -1,5 +1,51 @@
+import math
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba isn't available everywhere (e.g. some Raspberry Pi images), so fall back to plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+
+DEG2RAD = math.pi / 180.0
+
+# Kinds of step in the motion stack
+MOTION_MOVE = 0
+MOTION_TOOL = 1
+
+@njit(cache=True, fastmath=True)
+def _compute_pose(fx, fy, fz, tx, ty, tz, c, s, W, L):
+    """
+    Position of the tool relative to the ground, and the four ground-level corners of the frame
+
+    c and s are the cosine and sine of the frame rotation, W and L the frame's x and y dimensions
+    """
+    true_location = np.empty(3)
+    true_location[0] = fx + tx * c - ty * s
+    true_location[1] = fy + ty * c + tx * s
+    true_location[2] = tz
+
+    # Bottom right, bottom left, top right, top left
+    corners = np.empty((4, 3))
+    corners[0, 0] = fx
+    corners[0, 1] = fy
+    corners[1, 0] = fx - L * s
+    corners[1, 1] = fy + L * c
+    corners[2, 0] = fx + W * c
+    corners[2, 1] = fy + W * s
+    corners[3, 0] = fx + W * c - L * s
+    corners[3, 1] = fy + W * s + L * c
+    corners[:, 2] = fz
+
+    return true_location, corners
+
+# Compile now rather than on the first GUI tick
+_compute_pose(0., 0., 0., 0., 0., 0., 1., 0., 1., 1.)
+
 class RobotPlaceholder(object):
     def __init__(self, frame_location, tool_location, rotation, tool_status=0, water_quantity=99999):
 
@@ -22,18 +68,55 @@ class RobotPlaceholder(object):
         self.dimensions = [0.4, 1, 0.6]
 
         self.task_stack = []
-        self.motion_stack = []
+
+        # Incremented whenever the task stack or the status of a task in it changes, so displays can skip rebuilding
+        self.task_version = 0
+
+        # Motion stack, stored as one array per field rather than one list per step
+        # motion_xyz holds the 5-axis motion commands (see slice_motion), motion_task_id the task each belongs to
+        #   and motion_kind whether the step moves the robot (MOTION_MOVE) or fires the tool (MOTION_TOOL)
+        self.motion_xyz = np.empty((0, 5), dtype=np.float32)
+        self.motion_task_id = np.empty(0, dtype=np.int32)
+        self.motion_kind = np.empty(0, dtype=np.uint8)
+
+        # Index of the next step to be carried out. Steps before it have been completed
+        self.motion_head = 0
     
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, value):
+        self._rotation = value
+        self._trig_dirty = True
+
+    def _trig(self):
+        """
+        Cosine and sine of the frame rotation, only recalculated when the rotation has changed
+        """
+        if self._trig_dirty:
+            rad = self._rotation * DEG2RAD
+            self._c = math.cos(rad)
+            self._s = math.sin(rad)
+            self._trig_dirty = False
+
+        return(self._c, self._s)
+
     def update_task_queue(self):
         """
         Changes status variables on tasks in the queue based on what's happened to them
         """
-        task_ids_in_queue = []
-        for i in self.motion_stack:
-            task_ids_in_queue.append(i[5])
-        
+        # Number of outstanding motion steps for each task ID, counted in a single pass over the motion stack
+        # Sized to cover every task in the stack so each lookup is a plain list index
+        max_task_id = max((i["task_id"] for i in self.task_stack), default=-1)
+        counts = np.bincount(self.motion_task_id[self.motion_head:], minlength=max_task_id + 1).tolist()
+
+        new_task_stack = []
         for i in self.task_stack:
-            count = sum(x==i["task_id"] for x in task_ids_in_queue)
+            previous_status = i["task_status"]
+
+            count = counts[i["task_id"]]
             if count == i["motion_steps"]:
                 i["task_status"] = "In queue"
             elif count > 0 and count < i["motion_steps"]:
@@ -41,48 +124,41 @@ class RobotPlaceholder(object):
             elif count == 0:
                 i["task_status"] = "Complete"
 
-        new_task_stack = [s for s in self.task_stack if s["task_status"] != "Complete"]
+            if i["task_status"] != previous_status:
+                self.task_version += 1
+
+            if i["task_status"] != "Complete":
+                new_task_stack.append(i)
+
         self.task_stack = new_task_stack
 
+    def advance_motion_stack(self):
+        """
+        Marks the step at the head of the motion stack as completed
+
+        Completed steps are only dropped from the arrays once enough have built up, so advancing is O(1)
+        """
+        self.motion_head += 1
+
+        if self.motion_head > 1024 and self.motion_head > len(self.motion_task_id) // 2:
+            self.motion_xyz = self.motion_xyz[self.motion_head:].copy()
+            self.motion_task_id = self.motion_task_id[self.motion_head:].copy()
+            self.motion_kind = self.motion_kind[self.motion_head:].copy()
+            self.motion_head = 0
+
     def update_position(self):
         """
         When the state variables have been changed, update the position variables for rendering purposes
-
-        TODO: replace all this nonsense with a single matrix multiplication operation
         """
         # Update the task queue
         self.update_task_queue()
 
-        # Update the overall location nodes of the robot
-        self.true_location = [0, 0, 0]
-
-        self.true_location[2] = self.tool_location[2]
+        c, s = self._trig()
 
-        self.true_location[0] = (self.frame_location[0]  
-        + self.tool_location[0] * np.cos(np.deg2rad(self.rotation))
-        - self.tool_location[1] * np.sin(np.deg2rad(self.rotation)))
-
-        self.true_location[1] = (self.frame_location[1]  
-        + self.tool_location[1] * np.cos(np.deg2rad(self.rotation))
-        + self.tool_location[0] * np.sin(np.deg2rad(self.rotation)))
-
-
-        # Location of bottom right, bottom left, top right, top left corners of the frame. All positions on ground level
-        self.frame_corners = [list(self.frame_location),
-        list(self.frame_location), 
-        list(self.frame_location), 
-        list(self.frame_location)]
-
-        self.frame_corners[1][0] += (-self.dimensions[1] * np.sin(np.deg2rad(self.rotation)))
-        self.frame_corners[1][1] += (self.dimensions[1] * np.cos(np.deg2rad(self.rotation)))
-
-        self.frame_corners[2][0] += (self.dimensions[0] * np.cos(np.deg2rad(self.rotation)))
-        self.frame_corners[2][1] += (self.dimensions[0] * np.sin(np.deg2rad(self.rotation)))
-
-        self.frame_corners[3][0] += (self.dimensions[0] * np.cos(np.deg2rad(self.rotation))
-        - self.dimensions[1] * np.sin(np.deg2rad(self.rotation)))
-        self.frame_corners[3][1] += (self.dimensions[0] * np.sin(np.deg2rad(self.rotation))
-        + self.dimensions[1] * np.cos(np.deg2rad(self.rotation)))
+        self.true_location, self.frame_corners = _compute_pose(
+            float(self.frame_location[0]), float(self.frame_location[1]), float(self.frame_location[2]),
+            float(self.tool_location[0]), float(self.tool_location[1]), float(self.tool_location[2]),
+            c, s, float(self.dimensions[0]), float(self.dimensions[1]))
 
     def process_instruction_stack(self, tasks):
         """
@@ -93,6 +169,8 @@ class RobotPlaceholder(object):
         for i in tasks:
             self.task_stack.append(i)
 
+        self.task_version += 1
+
     def slice_motion(self, task):
         """
         Divide the motion required to reach a task destination into sections and feed them into the motion stack
@@ -101,114 +179,102 @@ class RobotPlaceholder(object):
         [Tool x (forwards), tool y (across gantry), tool z(up and down), frame x (forwards), frame y]
         """
 
-        steps = 0
-
         # Starts by copying either current location or location at end of motion stack
         # This means there are duplicates in the motion stack but it's a good way to safe the whole system
-        if len(self.motion_stack) == 0:
+        if self.motion_head == len(self.motion_task_id):
             position = [self.tool_location[0], self.tool_location[1], self.tool_location[2],
             self.frame_location[0], self.frame_location[1]]
         else:
-            position = self.motion_stack[-1]
-
-        # First task is always to move tool to neutral position. Fully raised, right hand side.
-        # This allows for endswitches to be triggered
-        self.motion_stack.append(
-            [position[0], 0, self.dimensions[2], 
-            position[3], position[4], 
-            task["task_id"]]
-        )
-        steps += 1
+            position = self.motion_xyz[-1]
 
         # Determine required frame location for task
         # NOTE for now we're assuming the frame is constrained to x travel only. This may eventually not be the case
         # Aims to have the task location (or middle of task box, if it fits entirely within the travel)
         #   in the middle of the frame
         if task["location_type"] == "point":
-            task_locations = [task["location"]]
+            task_locations = np.array([task["location"]], dtype=float)
 
         elif task["location_type"] == "grid":
             bounding_box = task["location"]
             grid_points = task["grid_points"]
-            task_locations = []
 
             x_spacing = abs(bounding_box[1][0] - bounding_box[0][0]) / grid_points[0]
             y_spacing = abs(bounding_box[1][1] - bounding_box[0][1]) / grid_points[1]
 
-            for x in range(grid_points[0]):
-                for y in range(grid_points[1]):
-                    task_locations.append(
-                        [bounding_box[0][0] + x * x_spacing,
-                        bounding_box[0][1] + y * y_spacing]
-                    )
-        
-        centre_of_task_locations = [0, 0]
-        valid_task_locations = []
-        for i in task_locations:
-            if i[1] < self.frame_location[1] or i[1] > (self.frame_location[1] + self.dimensions[1]):
-                # Task location is inaccessible from the robot
-                # Assuming it only moves in straight lines along the x axis
-                pass
-            else:
-                valid_task_locations.append(i)
-                centre_of_task_locations[0] += i[0]
-                centre_of_task_locations[1] += i[1]
-        
-        centre_of_task_locations[0] /= len(valid_task_locations)
-        centre_of_task_locations[1] /= len(valid_task_locations)
+            xs = bounding_box[0][0] + np.arange(grid_points[0]) * x_spacing
+            ys = bounding_box[0][1] + np.arange(grid_points[1]) * y_spacing
+            XX, YY = np.meshgrid(xs, ys, indexing="ij")
+            task_locations = np.stack([XX.ravel(), YY.ravel()], axis=1)
         
+        # Task locations outside the frame's y travel are inaccessible from the robot
+        # Assuming it only moves in straight lines along the x axis
+        valid = ((task_locations[:, 1] >= self.frame_location[1])
+            & (task_locations[:, 1] <= self.frame_location[1] + self.dimensions[1]))
+        valid_task_locations = task_locations[valid]
+
+        if len(valid_task_locations) == 0:
+            raise ValueError("Task " + str(task["task_id"]) + " has no locations within the frame's travel")
+
+        centre_of_task_locations = valid_task_locations.mean(axis=0)
         centre_of_task_locations[0] -= self.dimensions[0]/2.
 
-        # Move the frame so the centre lines up with the centre of the task envelope
+        # Two steps to get into position, then four for each task location
+        steps = 2 + 4 * len(valid_task_locations)
+        new_moves = np.empty((steps, 5), dtype=np.float32)
+        new_kind = np.full(steps, MOTION_MOVE, dtype=np.uint8)
 
-        self.motion_stack.append([self.tool_location[0], 0, self.dimensions[2], 
-            centre_of_task_locations[0], self.frame_location[1]
-            , task["task_id"]])
+        # First task is always to move tool to neutral position. Fully raised, right hand side.
+        # This allows for endswitches to be triggered
+        new_moves[0] = [position[0], 0, self.dimensions[2], position[3], position[4]]
 
-        steps += 1
-        
-        for i in valid_task_locations:
-            # For each task: move over it, lower down, fire tool, rise up
-
-            self.motion_stack.append([
-                i[0] - centre_of_task_locations[0], i[1], self.dimensions[2],
-                centre_of_task_locations[0], position[4]
-                , task["task_id"]])
-            
-            self.motion_stack.append([
-                i[0] - centre_of_task_locations[0], i[1], 0,
-                centre_of_task_locations[0], position[4]
-                , task["task_id"]])
-            
-            self.motion_stack.append(["Tool","Tool","Tool","Tool","Tool", task["task_id"]])
-
-            self.motion_stack.append([
-                i[0] - centre_of_task_locations[0], i[1], self.dimensions[2],
-                centre_of_task_locations[0], position[4]
-                , task["task_id"]])
-            
-            steps += 4
+        # Move the frame so the centre lines up with the centre of the task envelope
+        new_moves[1] = [self.tool_location[0], 0, self.dimensions[2],
+            centre_of_task_locations[0], self.frame_location[1]]
+
+        # For each task: move over it, lower down, fire tool, rise up
+        # Every fourth row from 2 onwards is the same step for successive task locations
+        task_moves = new_moves[2:]
+        task_moves[:, 0] = np.repeat(valid_task_locations[:, 0] - centre_of_task_locations[0], 4)
+        task_moves[:, 1] = np.repeat(valid_task_locations[:, 1], 4)
+        task_moves[:, 2] = self.dimensions[2]
+        task_moves[:, 3] = centre_of_task_locations[0]
+        task_moves[:, 4] = position[4]
+
+        # Lowered to fire the tool, which fires where it was lowered to
+        task_moves[1::4, 2] = 0
+        task_moves[2::4, 2] = 0
+        new_kind[4::4] = MOTION_TOOL
+
+        self.motion_xyz = np.concatenate([self.motion_xyz, new_moves])
+        self.motion_task_id = np.concatenate([self.motion_task_id,
+            np.full(steps, task["task_id"], dtype=np.int32)])
+        self.motion_kind = np.concatenate([self.motion_kind, new_kind])
     
         task["motion_steps"] = steps
-
-task_queue = []
-
-# PLaceholder tasks for now
-
-task_queue.append({
-    "operation_name":   "water",
-    "task_status":      "Awaiting slicing",
-    "location_type":    "point",
-    "location":         [0.5,0.2],
-    "toolhead":         "water_nozzle",
-    "task_id":          0
-})
-task_queue.append({
-    "operation_name":   "soil test",
-    "task_status":      "Awaiting slicing",
-    "location_type":    "grid",
-    "location":         [[1.2,0.1],[1.5, 1.0]], # corners of square
-    "grid_points":      [2, 3], # number of points in x and y
-    "toolhead":         "soil_sampler",
-    "task_id":          1
-})
+        self.task_version += 1
+
+def make_demo_task_queue():
+    """
+    Placeholder tasks for now, used by the visualiser
+    """
+    task_queue = []
+
+    task_queue.append({
+        "operation_name":   "water",
+        "task_status":      "Awaiting slicing",
+        "location_type":    "point",
+        "location":         [0.5,0.2],
+        "toolhead":         "water_nozzle",
+        "task_id":          0
+    })
+    task_queue.append({
+        "operation_name":   "soil test",
+        "task_status":      "Awaiting slicing",
+        "location_type":    "grid",
+        "location":         [[1.2,0.1],[1.5, 1.0]], # corners of square
+        "grid_points":      [2, 3], # number of points in x and y
+        "toolhead":         "soil_sampler",
+        "task_id":          1
+    })
+
+    return(task_queue)
@@ -1,3 +1,4 @@
+import math
 import numpy as np
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import PySimpleGUI as sg
@@ -7,10 +8,11 @@ from pygame import time
 
 from mpl_toolkits import mplot3d
 from mpl_toolkits.mplot3d import axes3d
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 
 # Argh lots of imports
 
-from main import *
+from main import RobotPlaceholder, MOTION_TOOL, make_demo_task_queue
 
 # Helper functions for graphics
 
@@ -52,74 +54,104 @@ def set_axes_equal(ax):
     ax.set_ylim3d([y_middle - plot_radius, y_middle + plot_radius])
     ax.set_zlim3d([z_middle - plot_radius, z_middle + plot_radius])
 
+# Each combo represents a line between two frame corners
+COMBOS = np.array([[0, 2], [0, 4], [2, 6], [4, 6],
+[1, 3], [1, 5], [3, 7], [5, 7],
+[4, 5], [6, 7]])
+
+def robot_geometry(robot):
+    """
+    Works out the lines needed to draw the robot from its current position variables
+
+    Returns the segments making up the frame and those making up the tool gantry, each as an (n, 2, 3) array
+    """
+    # Ground level corners followed by the corners at the top of the frame
+    frame_corners = np.empty((8, 3))
+    frame_corners[:4] = robot.frame_corners
+    frame_corners[4:] = robot.frame_corners
+    frame_corners[4:, 2] += robot.dimensions[2]
+
+    # Determine points to indicate the tool within the frame
+    c, s = robot._trig()
+    tool_corners = np.empty((4, 3))
+    tool_corners[0] = frame_corners[4]
+    tool_corners[1] = tool_corners[0]
+    tool_corners[1, 0] += robot.tool_location[0] * c
+    tool_corners[1, 1] += robot.tool_location[0] * s
+    tool_corners[2] = tool_corners[1]
+    tool_corners[2, 0] -= robot.tool_location[1] * s
+    tool_corners[2, 1] += robot.tool_location[1] * c
+    tool_corners[3] = robot.true_location
+
+    return(frame_corners[COMBOS], np.stack([tool_corners[:-1], tool_corners[1:]], axis=1))
+
 def plot_robot(robot, fig, ax, tool_active=False):
     """
     Plots robot's position on axes based on current state
-    Will need changing when we switch to a matrix based system
+
+    The artists are kept on the robot so later frames can move them with update_robot_artists
+    rather than replotting
     """
     robot.update_position()
-
-    frame_corners = robot.frame_corners
-    # Add the vertical corners of the frame
-    for i in frame_corners[0:4]:
-        frame_corners.append([
-            i[0],
-            i[1],
-            i[2] + robot.dimensions[2]
-        ])
-
-    # Each combo represents a line between two points
-    combos = [[0, 2], [0, 4], [2, 6], [4, 6],
-    [1, 3], [1, 5], [3, 7], [5, 7],
-    [4, 5], [6, 7]]
+    frame_segments, tool_segments = robot_geometry(robot)
 
     # Plot the frame of the robot
-    for i in combos:
-        start = frame_corners[i[0]]
-        end = frame_corners[i[1]]
-        ax.plot([start[0], end[0]], [start[1], end[1]], [start[2], end[2]], "green")
-    
-    # Determine points to indicate the tool within the frame
-    tool_corners = [frame_corners[4]]
-    tool_corners.append([
-        tool_corners[0][0] + robot.tool_location[0] * np.cos(np.deg2rad(robot.rotation)),
-        tool_corners[0][1] + robot.tool_location[0] * np.sin(np.deg2rad(robot.rotation)),
-        tool_corners[0][2]
-    ])
-    tool_corners.append([
-        tool_corners[1][0] - robot.tool_location[1] * np.sin(np.deg2rad(robot.rotation)),
-        tool_corners[1][1] + robot.tool_location[1] * np.cos(np.deg2rad(robot.rotation)),
-        tool_corners[0][2]
-    ])
-    tool_corners.append(robot.true_location)
-
-    for i in range(3):
-        start = tool_corners[i]
-        end = tool_corners[i + 1]
-        ax.plot([start[0], end[0]], [start[1], end[1]], [start[2], end[2]], "red", linewidth=3)
+    robot._frame_lines = Line3DCollection(frame_segments, colors="green")
+    ax.add_collection3d(robot._frame_lines)
+
+    robot._tool_lines = Line3DCollection(tool_segments, colors="red", linewidths=3)
+    ax.add_collection3d(robot._tool_lines)
     
+    end = tool_segments[-1, 1]
+    if tool_active:
+        robot._tool_dot = ax.scatter(end[0],end[1],end[2], c="b", linewidth=5)
+    else:
+        robot._tool_dot = ax.scatter(end[0],end[1],end[2], c="#cccccc", linewidth=5)
+
+    robot._drawn_state = None
+
+def update_robot_artists(robot, tool_active=False):
+    """
+    Moves the artists created by plot_robot to the robot's current position
+
+    Returns True if anything changed and the figure needs redrawing
+    """
+    robot.update_position()
+
+    state = (tuple(robot.frame_location), tuple(robot.tool_location), robot.rotation, tool_active)
+    if state == robot._drawn_state:
+        return(False)
+    robot._drawn_state = state
+
+    frame_segments, tool_segments = robot_geometry(robot)
+
+    robot._frame_lines.set_segments(frame_segments)
+    robot._tool_lines.set_segments(tool_segments)
+
+    end = tool_segments[-1, 1]
+    robot._tool_dot._offsets3d = ([end[0]], [end[1]], [end[2]])
     if tool_active:
-        ax.scatter(end[0],end[1],end[2], c="b", linewidth=5)
+        robot._tool_dot.set_color("b")
     else:
-        ax.scatter(end[0],end[1],end[2], c="#cccccc", linewidth=5)
+        robot._tool_dot.set_color("#cccccc")
+
+    return(True)
 
 def generate_command_list(robot):
     """
     Enunciates task stack for output purposes
     """
-    out = ""
-    for i in robot.task_stack:
-        out += (i["operation_name"] + " Task ID: "+str(i["task_id"]) + "\n")
-        out += ("     Location type: " + i["location_type"] + "\n")
-        out += ("     Status: " + i["task_status"] + "\n")
-    
-    return(out)
+    return("".join([
+        i["operation_name"] + " Task ID: " + str(i["task_id"]) + "\n"
+        + "     Location type: " + i["location_type"] + "\n"
+        + "     Status: " + i["task_status"] + "\n"
+        for i in robot.task_stack]))
 
 
 # GUI stuff
 left_column = [
     [sg.Text("Current vehicle status: "), 
-    sg.Text(robot_status, key="-STATUS-", background_color="white", text_color="black", size=(25,1))],
+    sg.Text("", key="-STATUS-", background_color="white", text_color="black", size=(25,1))],
     [sg.Text("Current command stack")],
     [sg.Multiline(default_text="", size=(40,30), auto_refresh=True, key="-STACK-")],
     [sg.Button("Start sim", key="-START-"), sg.Button("Pause sim", key="-PAUSE-")]
@@ -153,7 +185,7 @@ clock = time.Clock()
 # Robot initialisation
 
 farmm = RobotPlaceholder([0,0,0],[0.2,0.2,0.1],0)
-farmm.process_instruction_stack(task_queue)
+farmm.process_instruction_stack(make_demo_task_queue())
 for task in farmm.task_stack:
     farmm.slice_motion(task)
 
@@ -162,14 +194,25 @@ for task in farmm.task_stack:
 
 robot_status = ""
 
-previous_location = [farmm.frame_location, farmm.tool_location]
-next_location = []
+# Frame and tool locations at the start and end of the current motion. next_location is None when not moving
+previous_location = np.array([farmm.frame_location, farmm.tool_location], dtype=np.float32)
+next_location = None
 steps_required = 0
 steps_done = 0
 tool_active = False
 
 sim_running = False
 
+# Task stack version last shown in the command list
+last_rendered_version = None
+
+# Whether anything shown in the window has changed since it was last drawn
+# Part-way through a motion only the position changes, which is drawn every REDRAW_EVERY ticks rather than every tick
+dirty = True
+position_changed = False
+redraw_counter = 0
+REDRAW_EVERY = 5
+
 window = sg.Window("FARMM status viewer", layout, finalize=True)
 
 
@@ -191,30 +234,28 @@ while True:
         # Pause button pressed
         sim_running = False
 
-    elif next_location != [] and not tool_active and sim_running:
+    elif next_location is not None and not tool_active and sim_running:
         # Move the robot
 
         steps_done += 1
-        percent = steps_done/steps_required
+        percent = min(steps_done/steps_required, 1)
 
         # Update each coordinate based on what % of the motion has been carried out
-        updated_location = list(previous_location)
-        for i in range(0,2):
-            for j in range(0,3):
-                updated_location[i][j] += percent * (next_location[i][j] - previous_location[i][j])
-        
-        farmm.frame_location = updated_location[0]
-        farmm.tool_location = updated_location[1]
+        updated_location = previous_location + percent * (next_location - previous_location)
         
+        farmm.frame_location = updated_location[0].tolist()
+        farmm.tool_location = updated_location[1].tolist()
+        position_changed = True
 
         if percent >=1:
             # The motion has ended
-            previous_location = list(next_location)
-            next_location = []
+            previous_location = next_location
+            next_location = None
             steps_required = 0
             steps_done = 0
 
-            farmm.motion_stack.pop(0)
+            farmm.advance_motion_stack()
+            dirty = True
 
     elif tool_active and sim_running:
         # Fire the tool, increasing the number of steps done
@@ -225,69 +266,61 @@ while True:
             steps_required = 0
             steps_done = 0
 
-            farmm.motion_stack.pop(0)
+            farmm.advance_motion_stack()
+            dirty = True
 
-    if len(farmm.motion_stack) != 0 and next_location == [] and not tool_active and sim_running:
+    if farmm.motion_head < len(farmm.motion_task_id) and next_location is None and not tool_active and sim_running:
         # Select the next point from the motion stack and implement it
 
-        next_point = farmm.motion_stack[0]
+        next_point = farmm.motion_xyz[farmm.motion_head].tolist()
+        dirty = True
 
         # If the next point is a tool command, do a tool thing
-        if type(next_point[0]) == str:
+        if farmm.motion_kind[farmm.motion_head] == MOTION_TOOL:
             tool_active = True
             steps_required = 5
         
         else:
             # Set the appropriate location
-            next_location = [[next_point[3], next_point[4], 0], next_point[0:3]]
-
-            # Determine how long the action will take
-            max_frame_distance = max([
-                abs(previous_location[0][0] - next_location[0][0]),
-                abs(previous_location[0][1] - next_location[0][1]),
-                abs(previous_location[0][2] - next_location[0][2])
-            ])
-            max_tool_distance = max([
-                abs(previous_location[1][0] - next_location[1][0]),
-                abs(previous_location[1][1] - next_location[1][1]),
-                abs(previous_location[1][2] - next_location[1][2])
-            ])
-            if max_tool_distance > max_frame_distance:
-                # The tool travels at 0.1m/s
-                steps_required = max_tool_distance/0.1
-            else:
-                # The frame travels at 0.2m/s
-                steps_required = max_frame_distance/0.2
-    
-    window["-STACK-"].update(value=generate_command_list(farmm))
-
-
-    # Update the graph
-    ax.cla()
-    fig.clf()
-
-    ax = plt.axes(projection="3d")
-    ax.set_xlim3d(0, 2)
-    ax.set_ylim3d(-0.5, 1.5)
-    ax.set_zlim3d(0, 2)
-
-    plot_robot(farmm, fig, ax, tool_active)
-    fig_agg.draw()
-
-    # Set the robot status text
-    if next_location == [] and tool_active == False:
-        robot_status = "Inactive"
-    elif next_location == [] and tool_active == True:
-        robot_status = "Tool running"
-    elif next_location != []:
-        if next_location[0] == previous_location[0] and next_location[1] != previous_location[1]:
-            robot_status = "Tool moving inside frame"
-        elif next_location[0] != previous_location[0] and next_location[1] == previous_location[1]:
-            robot_status = "Frame moving, tool stationary"
-        elif next_location[0] != previous_location[0] and next_location[1] != previous_location[1]:
-            robot_status = "Both tool and frame moving"
+            next_location = np.array([[next_point[3], next_point[4], 0], next_point[0:3]], dtype=np.float32)
+
+            # Determine how long the action will take: the longer of the frame and tool travel times
+            # The frame travels at 0.2m/s and the tool at 0.1m/s
+            # Always at least one step, so repeated positions in the motion stack still complete
+            max_distance = np.abs(next_location - previous_location).max(axis=1)
+            steps_required = max(math.ceil(max(max_distance[0]/0.2, max_distance[1]/0.1)), 1)
     
-    window["-STATUS-"].update(robot_status)
+    redraw_counter += 1
+    if dirty or (position_changed and redraw_counter % REDRAW_EVERY == 0):
+        # Update the graph, moving the existing artists rather than replotting
+        # This also brings the task statuses up to date
+        if update_robot_artists(farmm, tool_active):
+            fig_agg.draw_idle()
+
+        # Only rebuild the command list when the task stack has changed
+        if farmm.task_version != last_rendered_version:
+            window["-STACK-"].update(value=generate_command_list(farmm))
+            last_rendered_version = farmm.task_version
+
+        # Set the robot status text
+        if next_location is None and tool_active == False:
+            robot_status = "Inactive"
+        elif next_location is None and tool_active == True:
+            robot_status = "Tool running"
+        elif next_location is not None:
+            frame_moving = not np.array_equal(next_location[0], previous_location[0])
+            tool_moving = not np.array_equal(next_location[1], previous_location[1])
+            if not frame_moving and tool_moving:
+                robot_status = "Tool moving inside frame"
+            elif frame_moving and not tool_moving:
+                robot_status = "Frame moving, tool stationary"
+            elif frame_moving and tool_moving:
+                robot_status = "Both tool and frame moving"
+        
+        window["-STATUS-"].update(robot_status)
+
+        dirty = False
+        position_changed = False
     
-    # Limits to 20 FPS
+    # Runs the simulation and checks for GUI events at 20Hz
     clock.tick(20)